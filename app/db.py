@@ -1,14 +1,25 @@
 import sqlalchemy
 from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.sql import func as sqlfunc
-from databases import Database
 from decouple import config
 
 
 DATABASE_URL = config("DATABASE_URL")
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=20, cast=int)
+DB_MAX_OVERFLOW = config("DB_MAX_OVERFLOW", default=10, cast=int)
+# Disable on workers that should not check or create the schema at startup
+RUN_MIGRATIONS = config("RUN_MIGRATIONS", default=True, cast=bool)
 
 
-database = Database(DATABASE_URL)
+# Async engine with a per-worker connection pool used by the API handlers
+engine = create_async_engine(
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
 metadata = sqlalchemy.MetaData()
 
 
@@ -27,6 +38,15 @@ messages = sqlalchemy.Table(
     sqlalchemy.Column("sender_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("users.id"), nullable=False),
     sqlalchemy.Column("recipient_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("users.id"), nullable=False),
     sqlalchemy.Column("ciphertext", sqlalchemy.LargeBinary, nullable=False),
+    sqlalchemy.Index("ix_messages_sender_id_id", "sender_id", "id"),
+    sqlalchemy.Index("ix_messages_recipient_id_id", "recipient_id", "id"),
+)
+# Ciphertext is incompressible, so store it out of line without attempting
+# compression; rows scanned for history stay small when the body is skipped
+sqlalchemy.event.listen(
+    messages,
+    "after_create",
+    sqlalchemy.DDL("ALTER TABLE messages ALTER COLUMN ciphertext SET STORAGE EXTERNAL"),
 )
 
 
@@ -34,25 +54,114 @@ message_hashes = sqlalchemy.Table(
     "message_hashes",
     metadata,
     sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True),
-    sqlalchemy.Column("recipient_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("users.id"), nullable=False, index=True),
-    sqlalchemy.Column("message_hash", sqlalchemy.String(64), nullable=False),
+    sqlalchemy.Column("recipient_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Column("message_hash", sqlalchemy.LargeBinary(32), nullable=False),
     sqlalchemy.Column("created_at", sqlalchemy.DateTime(timezone=True), server_default=sqlfunc.now(), nullable=False),
+    sqlalchemy.UniqueConstraint("recipient_id", "message_hash", name="uq_message_hashes_recipient_id_message_hash"),
+    sqlalchemy.Index("ix_message_hashes_recipient_id_created_at", "recipient_id", "created_at"),
 )
 
 
-# Engine for creating tables
-engine = sqlalchemy.create_engine(DATABASE_URL)
+# Arbitrary key for the advisory lock that serializes concurrent migrators
+SCHEMA_LOCK_ID = 804_120_001
+
+# Indexes added after the first version of the schema, as
+# (table, name, statement). create_all() never alters existing tables, so
+# these are created on upgrade when missing.
+INDEX_UPGRADES = [
+    (
+        "message_hashes",
+        "uq_message_hashes_recipient_id_message_hash",
+        "CREATE UNIQUE INDEX uq_message_hashes_recipient_id_message_hash "
+        "ON message_hashes (recipient_id, message_hash)",
+    ),
+    (
+        "message_hashes",
+        "ix_message_hashes_recipient_id_created_at",
+        "CREATE INDEX ix_message_hashes_recipient_id_created_at "
+        "ON message_hashes (recipient_id, created_at)",
+    ),
+    ("messages", "ix_messages_sender_id_id", "CREATE INDEX ix_messages_sender_id_id ON messages (sender_id, id)"),
+    ("messages", "ix_messages_recipient_id_id", "CREATE INDEX ix_messages_recipient_id_id ON messages (recipient_id, id)"),
+]
+
+# Superseded by the (recipient_id, ...) indexes above
+LEGACY_INDEXES = [("message_hashes", "ix_message_hashes_recipient_id")]
+
+
+def _index_names(inspector, table):
+    names = {index["name"] for index in inspector.get_indexes(table)}
+    names.update(constraint["name"] for constraint in inspector.get_unique_constraints(table))
+    return names
+
 
+def _upgrade_tables(connection, inspector):
+    """
+    Brings tables created by earlier versions of the schema in line with the
+    definitions above. Each step only runs when the schema still needs it, so
+    an up-to-date database takes no table locks.
+    """
+    # Hashes used to be stored as 64-character hex strings
+    columns = {column["name"]: column["type"] for column in inspector.get_columns("message_hashes")}
+    if not isinstance(columns["message_hash"], sqlalchemy.LargeBinary):
+        print("Converting message_hashes.message_hash to BYTEA...")
+        connection.execute(sqlalchemy.text(
+            "ALTER TABLE message_hashes "
+            "ALTER COLUMN message_hash TYPE BYTEA USING decode(message_hash, 'hex')"
+        ))
 
-def check_and_create_tables():
-    """Checks if the required tables exist and creates them if they don't."""
-    inspector = inspect(engine)
+    index_names = {table: _index_names(inspector, table) for table in ("messages", "message_hashes")}
+    for table, name, statement in INDEX_UPGRADES:
+        if name in index_names[table]:
+            continue
+        if name == "uq_message_hashes_recipient_id_message_hash":
+            # The old check-then-insert flow could store the same hash twice
+            connection.execute(sqlalchemy.text(
+                "DELETE FROM message_hashes a USING message_hashes b "
+                "WHERE a.recipient_id = b.recipient_id "
+                "AND a.message_hash = b.message_hash AND a.id > b.id"
+            ))
+        print(f"Creating index {name}...")
+        connection.execute(sqlalchemy.text(statement))
+
+    for table, name in LEGACY_INDEXES:
+        if name in index_names[table]:
+            print(f"Dropping index {name}...")
+            connection.execute(sqlalchemy.text(f"DROP INDEX {name}"))
+
+    storage = connection.scalar(sqlalchemy.text(
+        "SELECT attstorage FROM pg_attribute "
+        "WHERE attrelid = 'messages'::regclass AND attname = 'ciphertext'"
+    ))
+    if storage != "e":
+        print("Setting messages.ciphertext storage to EXTERNAL...")
+        connection.execute(sqlalchemy.text(
+            "ALTER TABLE messages ALTER COLUMN ciphertext SET STORAGE EXTERNAL"
+        ))
+
+
+def _create_missing_tables(connection):
+    inspector = inspect(connection)
     required_tables = {"users", "messages", "message_hashes"}
     existing_tables = set(inspector.get_table_names())
 
     if not required_tables.issubset(existing_tables):
         print("One or more tables are missing. Creating all tables...")
-        metadata.create_all(bind=engine)
+        metadata.create_all(bind=connection)
         print("Tables created successfully.")
     else:
         print("Tables already exist.")
+
+    _upgrade_tables(connection, inspect(connection))
+
+
+async def check_and_create_tables():
+    """
+    Checks if the required tables exist and creates them if they don't, then
+    upgrades tables created by earlier versions of the schema.
+    """
+    # Runs over the async engine's pool, so no separate sync engine is needed
+    async with engine.begin() as conn:
+        # Workers starting together would otherwise race on the same DDL
+        await conn.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_ID})
+        await conn.run_sync(_create_missing_tables)
@@ -1,50 +1,183 @@
 import asyncio
 import hashlib
+import heapq
+import operator
 import sqlalchemy
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from contextlib import asynccontextmanager
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 
-from fastapi import FastAPI, Request, Header, HTTPException, Query
+import msgpack
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, Request, Response, Header, HTTPException, Query
 
-from .db import database, users, messages, message_hashes, check_and_create_tables
+from .db import RUN_MIGRATIONS, engine, users, messages, check_and_create_tables
 
 # --- Constants ---
 REPLAY_ATTACK_HASH_COUNT = 50
 POLL_TIMEOUT = 45  # seconds
+MAX_MESSAGE_SIZE = 10 * 1024 * 1024  # bytes
+USER_CACHE_SIZE = 10_000
+USER_CACHE_TTL = 600  # seconds
+
+# Stores a new replay-protection hash and trims the recipient's hashes to the
+# newest REPLAY_ATTACK_HASH_COUNT in a single round-trip. Returns no row if the
+# hash is already stored for the recipient (a replayed message). The DELETE does
+# not see the row inserted by the CTE, so it keeps one fewer of the existing rows.
+STORE_MESSAGE_HASH = sqlalchemy.text("""
+    WITH inserted AS (
+        INSERT INTO message_hashes (recipient_id, message_hash)
+        VALUES (:recipient_id, :message_hash)
+        ON CONFLICT (recipient_id, message_hash) DO NOTHING
+        RETURNING id
+    ), trimmed AS (
+        DELETE FROM message_hashes
+        WHERE EXISTS (SELECT 1 FROM inserted)
+          AND id IN (
+            SELECT id FROM message_hashes
+            WHERE recipient_id = :recipient_id
+            ORDER BY created_at DESC, id DESC
+            OFFSET :keep
+          )
+    )
+    SELECT id FROM inserted
+""")
+
+# --- Hot statements ---
+# Built once with bound parameters so every call renders identical SQL:
+# SQLAlchemy reuses the compiled statement and asyncpg reuses the statement it
+# prepared on each pooled connection instead of parsing and planning it again.
+PUBLIC_KEYS = sqlalchemy.bindparam("public_keys", type_=ARRAY(sqlalchemy.Text))
+
+SELECT_USER_ID = sqlalchemy.select(users.c.id).where(
+    users.c.public_key == sqlalchemy.bindparam("public_key")
+)
+SELECT_USER_IDS = sqlalchemy.select(users.c.id, users.c.public_key).where(
+    users.c.public_key == sqlalchemy.any_(PUBLIC_KEYS)
+)
+# DO UPDATE (not DO NOTHING) so RETURNING yields the id for rows created
+# concurrently by another request too
+INSERT_USERS = pg_insert(users).from_select(
+    ["public_key"], sqlalchemy.select(sqlalchemy.func.unnest(PUBLIC_KEYS))
+)
+INSERT_USERS = INSERT_USERS.on_conflict_do_update(
+    index_elements=[users.c.public_key],
+    set_={"public_key": INSERT_USERS.excluded.public_key},
+).returning(users.c.id, users.c.public_key)
+INSERT_MESSAGE = messages.insert().returning(messages.c.id)
+
+# Columns returned by message history, with their keys computed once so rows
+# can be zipped into dicts without building a mapping per row
+MESSAGE_COLUMNS = tuple(messages.c)
+MESSAGE_METADATA_COLUMNS = (messages.c.id, messages.c.sender_id, messages.c.recipient_id)
+MESSAGE_KEYS = tuple(column.key for column in MESSAGE_COLUMNS)
+MESSAGE_METADATA_KEYS = tuple(column.key for column in MESSAGE_METADATA_COLUMNS)
 
 # --- In-memory state for Long Polling ---
 # These are not suitable for multi-worker production environments.
 # A proper implementation would use a message queue like Redis Pub/Sub.
-waiting_clients: Dict[int, asyncio.Event] = {}
-new_messages: Dict[int, List] = {}
+poll_queues: Dict[int, asyncio.Queue] = {}
+# Number of polls currently waiting on each user's queue
+poll_waiters: Dict[int, int] = {}
+
+# --- In-memory user cache ---
+# Maps public keys to user IDs. Users are never updated or deleted, so cached
+# entries cannot go stale; the TTL only bounds how long unused keys are kept.
+user_cache: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Handles application startup and shutdown events."""
-    check_and_create_tables()
-    await database.connect()
+    if RUN_MIGRATIONS:
+        await check_and_create_tables()
     yield
-    await database.disconnect()
+    await engine.dispose()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+def _encode_bytes(value):
+    # Ciphertext is sent as the text the client uploaded, as FastAPI's
+    # jsonable_encoder did; raw bytes are served by the MessagePack endpoints
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError
+
+
+def json_response(rows: List[dict]) -> Response:
+    """Serializes rows straight to JSON with orjson, decoding bytes as UTF-8 text."""
+    return Response(orjson.dumps(rows, default=_encode_bytes), media_type="application/json")
+
+
+def msgpack_response(rows: List[dict]) -> Response:
+    """Serializes rows to MessagePack, keeping bytes as raw binary."""
+    return Response(msgpack.packb(rows, use_bin_type=True), media_type="application/msgpack")
+
+
 async def get_user(public_key: str) -> Optional[int]:
     """Retrieves a user's ID by their public key."""
-    query = users.select().where(users.c.public_key == public_key)
-    user = await database.fetch_one(query)
-    return user["id"] if user else None
+    user_id = user_cache.get(public_key)
+    if user_id is not None:
+        return user_id
 
+    async with engine.connect() as conn:
+        user_id = await conn.scalar(SELECT_USER_ID, {"public_key": public_key})
+    if user_id is not None:
+        user_cache[public_key] = user_id
+    return user_id
 
-async def get_or_create_user(public_key: str) -> int:
-    """Retrieves a user's ID by their public key, creating one if not found."""
-    user_id = await get_user(public_key)
-    if user_id:
-        return user_id
-    query = users.insert().values(public_key=public_key)
-    return await database.execute(query)
+
+async def find_users(public_keys: List[str]) -> Dict[str, int]:
+    """
+    Maps public keys to user IDs with a single lookup. Keys without a user
+    are left out of the result.
+    """
+    cached = ((key, user_cache.get(key)) for key in public_keys)
+    user_ids = {key: user_id for key, user_id in cached if user_id is not None}
+    keys = [key for key in dict.fromkeys(public_keys) if key not in user_ids]
+    if not keys:
+        return user_ids
+
+    async with engine.connect() as conn:
+        result = await conn.execute(SELECT_USER_IDS, {"public_keys": keys})
+        found = {row.public_key: row.id for row in result}
+
+    user_cache.update(found)
+    user_ids.update(found)
+    return user_ids
+
+
+async def create_users(public_keys: List[str]) -> Dict[str, int]:
+    """
+    Creates users for the given public keys in one batched insert and returns
+    their IDs, including those of users created concurrently by another request.
+    """
+    # Sorted so concurrent requests take the unique-index locks on new keys in
+    # the same order and cannot deadlock each other
+    async with engine.begin() as conn:
+        result = await conn.execute(INSERT_USERS, {"public_keys": sorted(set(public_keys))})
+        user_ids = {row.public_key: row.id for row in result}
+
+    user_cache.update(user_ids)
+    return user_ids
+
+
+async def read_message_body(request: Request) -> Tuple[bytes, bytes]:
+    """
+    Reads the request body, hashing it as chunks arrive, and returns the
+    ciphertext with its raw SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    body = bytearray()
+    async for chunk in request.stream():
+        if len(body) + len(chunk) > MAX_MESSAGE_SIZE:
+            raise HTTPException(status_code=413, detail="Message is too large.")
+        digest.update(chunk)
+        body.extend(chunk)
+    return bytes(body), digest.digest()
 
 
 @app.post("/messages/")
@@ -57,66 +190,72 @@ async def save_message(
     Saves an encrypted message, protects against replay attacks, and notifies
     long-polling clients.
     """
-    ciphertext = await request.body()
-    if not ciphertext:
-        raise HTTPException(status_code=400, detail="Request body cannot be empty.")
+    # Reject oversized messages by their declared size before reading the body
+    # or touching the database; the streaming read still enforces the limit
+    # for chunked uploads
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_MESSAGE_SIZE:
+        raise HTTPException(status_code=413, detail="Message is too large.")
 
-    message_hash = hashlib.sha256(ciphertext).hexdigest()
+    public_keys = [x_sender_public_key, x_recipient_public_key]
 
     try:
-        sender_id = await get_or_create_user(x_sender_public_key)
-        recipient_id = await get_or_create_user(x_recipient_public_key)
-
-        # Replay attack check
-        query = message_hashes.select().where(
-            (message_hashes.c.recipient_id == recipient_id) &
-            (message_hashes.c.message_hash == message_hash)
-        )
-        if await database.fetch_one(query):
-            raise HTTPException(status_code=409, detail="Duplicate message detected.")
+        # The read-only user lookup overlaps with the upload. Missing users are
+        # only created once the body is valid, so a rejected request writes
+        # nothing.
+        lookup = asyncio.create_task(find_users(public_keys))
+        try:
+            ciphertext, message_hash = await read_message_body(request)
+            if not ciphertext:
+                raise HTTPException(status_code=400, detail="Request body cannot be empty.")
+        except BaseException:
+            lookup.cancel()
+            raise
+
+        user_ids = await lookup
+        missing = [key for key in public_keys if key not in user_ids]
+        if missing:
+            user_ids.update(await create_users(missing))
+
+        sender_id = user_ids[x_sender_public_key]
+        recipient_id = user_ids[x_recipient_public_key]
 
         message_id = None
-        async with database.transaction():
-            # 1. Insert the message
-            query = messages.insert().values(
-                sender_id=sender_id,
-                recipient_id=recipient_id,
-                ciphertext=ciphertext,
+        async with engine.begin() as conn:
+            # 1. Add the new hash for replay protection and clean up old hashes.
+            # A conflict on the unique hash means the message was replayed.
+            hash_id = await conn.scalar(
+                STORE_MESSAGE_HASH,
+                {
+                    "recipient_id": recipient_id,
+                    "message_hash": message_hash,
+                    "keep": REPLAY_ATTACK_HASH_COUNT - 1,
+                },
             )
-            message_id = await database.execute(query)
-
-            # 2. Add the new hash for replay protection
-            query = message_hashes.insert().values(
-                recipient_id=recipient_id, message_hash=message_hash
+            if hash_id is None:
+                raise HTTPException(status_code=409, detail="Duplicate message detected.")
+
+            # 2. Insert the message
+            message_id = await conn.scalar(
+                INSERT_MESSAGE,
+                {
+                    "sender_id": sender_id,
+                    "recipient_id": recipient_id,
+                    "ciphertext": ciphertext,
+                },
             )
-            await database.execute(query)
 
-            # 3. Clean up old hashes
-            count_query = sqlalchemy.select(sqlalchemy.func.count()).select_from(message_hashes).where(
-                message_hashes.c.recipient_id == recipient_id
-            )
-            hash_count = await database.fetch_val(count_query)
-            if hash_count > REPLAY_ATTACK_HASH_COUNT:
-                oldest_hash_id_query = sqlalchemy.select(message_hashes.c.id).where(
-                    message_hashes.c.recipient_id == recipient_id
-                ).order_by(message_hashes.c.created_at.asc()).limit(1)
-                oldest_hash_id = await database.fetch_val(oldest_hash_id_query)
-                if oldest_hash_id:
-                    await database.execute(
-                        message_hashes.delete().where(message_hashes.c.id == oldest_hash_id)
-                    )
-
-        # Notify waiting long-poll client, if any
-        if recipient_id in waiting_clients:
-            message_query = messages.select().where(messages.c.id == message_id)
-            new_message_data = await database.fetch_one(message_query)
-            # Ensure new_messages list exists for the recipient
-            if recipient_id not in new_messages:
-                new_messages[recipient_id] = []
-            new_messages[recipient_id].append(dict(new_message_data))
-            waiting_clients[recipient_id].set()
-
-        return {"message_id": message_id}
+        # Notify waiting long-poll client, if any. Messages are only queued while
+        # a poll is waiting, so nothing accumulates for users who stopped polling.
+        if poll_waiters.get(recipient_id):
+            poll_queues[recipient_id].put_nowait({
+                "id": message_id,
+                "sender_id": sender_id,
+                "recipient_id": recipient_id,
+                "ciphertext": ciphertext,
+            })
+
+        return Response(b'{"message_id":%d}' % message_id, media_type="application/json")
 
     except HTTPException as e:
         raise e  # Re-raise to preserve status code and detail
@@ -124,57 +263,77 @@ async def save_message(
         raise HTTPException(status_code=500, detail=f"Failed to save message: {e}")
 
 
-@app.get("/poll/messages")
-async def poll_for_messages(request: Request, public_key: str):
+async def wait_for_messages(public_key: str) -> List[dict]:
     """
     Waits for new messages for a given public key (Long Polling).
-    Responds immediately if messages are pending, otherwise waits for
-    `POLL_TIMEOUT` seconds.
+    Returns immediately if messages are pending, otherwise waits for
+    `POLL_TIMEOUT` seconds and returns an empty list if none arrive.
     """
     user_id = await get_user(public_key)
     if not user_id:
         raise HTTPException(status_code=404, detail="User not found.")
-    
-    # If messages already arrived while not polling, return them immediately
-    if user_id in new_messages and new_messages[user_id]:
-        messages_to_return = new_messages.pop(user_id)
-        return messages_to_return
 
-    event = asyncio.Event()
-    waiting_clients[user_id] = event
-    
-    # Initialize message list for this polling cycle
-    new_messages[user_id] = []
+    queue = poll_queues.setdefault(user_id, asyncio.Queue())
+    poll_waiters[user_id] = poll_waiters.get(user_id, 0) + 1
 
     try:
-        # Wait for the event to be set or timeout
-        await asyncio.wait_for(event.wait(), timeout=POLL_TIMEOUT)
-        
-        # If event was set, retrieve messages
-        messages_to_return = new_messages.get(user_id, [])
+        try:
+            # Wait for the first message or timeout
+            messages_to_return = [await asyncio.wait_for(queue.get(), timeout=POLL_TIMEOUT)]
+        except asyncio.TimeoutError:
+            # No message woke the wait in time, but one may have been queued
+            # as it timed out; it is picked up below
+            messages_to_return = []
+
+        # Take everything else queued
+        while not queue.empty():
+            messages_to_return.append(queue.get_nowait())
         return messages_to_return
 
-    except asyncio.TimeoutError:
-        # No new messages within the timeout window
-        return [] # Return 200 OK with an empty list
-    
     finally:
-        # Clean up after the request is done
-        if user_id in waiting_clients:
-            del waiting_clients[user_id]
-        if user_id in new_messages:
-            del new_messages[user_id]
+        # The queue is shared by concurrent polls for the same user, so only
+        # the last one to leave removes it. Nothing yields between draining
+        # and this cleanup, so no message can be queued in between and lost.
+        poll_waiters[user_id] -= 1
+        if not poll_waiters[user_id]:
+            del poll_waiters[user_id]
+            del poll_queues[user_id]
 
 
-@app.get("/messages/")
-async def get_messages(
+@app.get("/poll/messages")
+async def poll_for_messages(public_key: str):
+    """
+    Waits for new messages for a given public key (Long Polling).
+    Responds immediately if messages are pending, otherwise waits for
+    `POLL_TIMEOUT` seconds.
+    """
+    return json_response(await wait_for_messages(public_key))
+
+
+@app.get("/poll/messages/binary")
+async def poll_for_messages_binary(public_key: str):
+    """
+    Same as `/poll/messages`, but responds with MessagePack, with the
+    ciphertext sent as raw bytes.
+    """
+    return msgpack_response(await wait_for_messages(public_key))
+
+
+async def fetch_all(query) -> list:
+    """Runs a query on its own pooled connection and returns its rows."""
+    async with engine.connect() as conn:
+        return (await conn.execute(query)).all()
+
+
+async def fetch_message_history(
     public_key: str,
-    since_id: Optional[int] = Query(None, description="Get messages with ID greater than this."),
-    until_id: Optional[int] = Query(None, description="Get messages with ID less than this."),
-    limit: int = Query(100, description="Number of messages to retrieve."),
-):
+    since_id: Optional[int],
+    until_id: Optional[int],
+    limit: int,
+    include_body: bool,
+) -> List[dict]:
     """
-    Retrieves historical messages for a given public key.
+    Retrieves historical messages for a given public key in chronological order.
     """
     if since_id is not None and until_id is not None:
         raise HTTPException(status_code=400, detail="Cannot use 'since_id' and 'until_id' at the same time.")
@@ -183,22 +342,64 @@ async def get_messages(
     if not user_id:
         return []
 
-    query = messages.select().where(
-        (messages.c.sender_id == user_id) | (messages.c.recipient_id == user_id)
+    # Sent and received messages are fetched by two concurrent queries, each a
+    # range scan on its (user, id) index, instead of one OR that cannot use a
+    # single index. Messages to oneself are only taken from the sent side.
+    if include_body:
+        columns, keys = MESSAGE_COLUMNS, MESSAGE_KEYS
+    else:
+        columns, keys = MESSAGE_METADATA_COLUMNS, MESSAGE_METADATA_KEYS
+
+    def history_query(condition):
+        query = sqlalchemy.select(*columns).where(condition)
+        if since_id is not None:
+            return query.where(messages.c.id > since_id).order_by(messages.c.id.asc()).limit(limit)
+        if until_id is not None:
+            query = query.where(messages.c.id < until_id)
+        # Take the newest messages, then put them back in chronological order
+        newest = query.order_by(messages.c.id.desc()).limit(limit).subquery()
+        return sqlalchemy.select(newest).order_by(newest.c.id.asc())
+
+    sent, received = await asyncio.gather(
+        fetch_all(history_query(messages.c.sender_id == user_id)),
+        fetch_all(history_query((messages.c.recipient_id == user_id) & (messages.c.sender_id != user_id))),
     )
 
+    # Both sides are in chronological order (id is the first column); keep the
+    # oldest `limit` after since_id, otherwise the newest `limit`
+    results = list(heapq.merge(sent, received, key=operator.itemgetter(0)))
     if since_id is not None:
-        query = query.where(messages.c.id > since_id).order_by(messages.c.id.asc())
-    elif until_id is not None:
-        query = query.where(messages.c.id < until_id).order_by(messages.c.id.desc())
+        results = results[:limit]
     else:
-        query = query.order_by(messages.c.id.desc())
+        results = results[max(len(results) - limit, 0):]
 
-    query = query.limit(limit)
-    results = await database.fetch_all(query)
+    return [dict(zip(keys, row)) for row in results]
 
-    # Reverse results if needed to maintain chronological order
-    if until_id is not None or (since_id is None and until_id is None):
-        return [dict(row) for row in reversed(results)]
 
-    return [dict(row) for row in results]
\ No newline at end of file
+@app.get("/messages/")
+async def get_messages(
+    public_key: str,
+    since_id: Optional[int] = Query(None, description="Get messages with ID greater than this."),
+    until_id: Optional[int] = Query(None, description="Get messages with ID less than this."),
+    limit: int = Query(100, description="Number of messages to retrieve."),
+    include_body: bool = Query(True, description="Include the message ciphertext."),
+):
+    """
+    Retrieves historical messages for a given public key.
+    """
+    return json_response(await fetch_message_history(public_key, since_id, until_id, limit, include_body))
+
+
+@app.get("/messages/binary")
+async def get_messages_binary(
+    public_key: str,
+    since_id: Optional[int] = Query(None, description="Get messages with ID greater than this."),
+    until_id: Optional[int] = Query(None, description="Get messages with ID less than this."),
+    limit: int = Query(100, description="Number of messages to retrieve."),
+    include_body: bool = Query(True, description="Include the message ciphertext."),
+):
+    """
+    Retrieves historical messages for a given public key as MessagePack, with
+    the ciphertext sent as raw bytes instead of being encoded for JSON.
+    """
+    return msgpack_response(await fetch_message_history(public_key, since_id, until_id, limit, include_body))